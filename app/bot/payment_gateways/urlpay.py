@@ -1,11 +1,14 @@
+import asyncio
 import hashlib
 import os
 import logging
 import uuid
 from decimal import Decimal, ROUND_HALF_UP
+from enum import Enum, auto
 from typing import Any
 
 import aiohttp
+import orjson
 from aiogram import Bot
 from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.utils.i18n import I18n
@@ -24,6 +27,24 @@ from app.db.models import Transaction
 
 logger = logging.getLogger(__name__)
 
+_AMOUNT_QUANT = Decimal("0.01")
+_STATUS_SUCCESS = frozenset({3})
+_STATUS_CANCEL = frozenset({4, 5, 6})
+_STATUS_MAP = {
+    "success": _STATUS_SUCCESS,
+    "cancel": _STATUS_CANCEL,
+}
+_STATUS_HANDLERS = {
+    "success": "handle_payment_succeeded",
+    "cancel": "handle_payment_canceled",
+}
+
+
+class _CallbackResult(Enum):
+    VERIFIED = auto()
+    REJECTED = auto()
+    ALREADY_COMPLETED = auto()
+
 
 class UrlPay(PaymentGateway):
     name = ""
@@ -41,6 +62,13 @@ class UrlPay(PaymentGateway):
         i18n: I18n,
         services: ServicesContainer,
     ) -> None:
+        if not (
+            config.urlpay.API_KEY
+            and config.urlpay.SHOP_ID is not None
+            and config.urlpay.SECRET_KEY
+        ):
+            raise RuntimeError("UrlPay credentials are not configured.")
+
         self.name = _("payment:gateway:urlpay")
         self.app = app
         self.config = config
@@ -49,70 +77,77 @@ class UrlPay(PaymentGateway):
         self.bot = bot
         self.i18n = i18n
         self.services = services
+        self._http: aiohttp.ClientSession | None = None
+        self._processing: set[tuple[str, str, str]] = set()
+        self._redirect_url: str | None = None
+        self._description_templates: dict[str, str] = {}
+        self._redirect_url_lock = asyncio.Lock()
+        self._auth_headers = {
+            "Authorization": f"Bearer {config.urlpay.API_KEY}",
+            "Content-Type": "application/json",
+        }
+        self._sig_prefix_hash = hashlib.sha1(self.currency.code.lower().encode())
+        self._sig_suffix = f"{config.urlpay.SHOP_ID}{config.urlpay.SECRET_KEY}".encode()
+        self._payload_template = {
+            "currency": self.currency.code.lower(),
+            "shopId": config.urlpay.SHOP_ID,
+            "language": "ru",
+        }
+        self._item_template = {
+            "quantity": 1,
+            "vat_code": 0,
+            "payment_subject": 4,
+            "payment_mode": 1,
+        }
 
         self.app.router.add_post(URLPAY_WEBHOOK, self.webhook_handler)
+        self.app.on_cleanup.append(self._on_cleanup)
         logger.info("UrlPay payment gateway initialized.")
 
     async def create_payment(self, data: SubscriptionData) -> str:
-        if not all(
-            [
-                self.config.urlpay.API_KEY,
-                self.config.urlpay.SHOP_ID,
-                self.config.urlpay.SECRET_KEY,
-            ]
-        ):
-            raise RuntimeError("UrlPay credentials are not configured.")
-
-        bot_username = (await self.bot.get_me()).username
-        redirect_url = f"https://t.me/{bot_username}"
+        redirect_url = await self._get_redirect_url()
 
-        description = _("payment:invoice:description").format(
+        locale = self.i18n.current_locale
+        template = self._description_templates.get(locale)
+        if template is None:
+            template = self._description_templates.setdefault(
+                locale, _("payment:invoice:description")
+            )
+        description = template.format(
             devices=format_device_count(data.devices),
             duration=format_subscription_period(data.duration),
         )
 
-        amount = (
-            Decimal(str(data.price))
-            .quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        )
-        amount_str = format(amount, ".2f")
+        amount_str = format(Decimal(str(data.price)).quantize(_AMOUNT_QUANT, ROUND_HALF_UP), "f")
 
         order_uuid = str(uuid.uuid4())
 
         payload: dict[str, Any] = {
-            "currency": self.currency.code.lower(),
+            **self._payload_template,
             "amount": amount_str,
             "uuid": order_uuid,
-            "shopId": self.config.urlpay.SHOP_ID,
             "description": description,
             "website_url": redirect_url,
-            "language": "ru",
             "sign": self._generate_signature(amount_str),
             "items": [
                 {
+                    **self._item_template,
                     "description": description,
-                    "quantity": 1,
                     "price": amount_str,
-                    "vat_code": 0,
-                    "payment_subject": 4,
-                    "payment_mode": 1,
                 }
             ],
         }
 
-        headers = {
-            "Authorization": f"Bearer {self.config.urlpay.API_KEY}",
-            "Content-Type": "application/json",
-        }
-
-        async with aiohttp.ClientSession() as session:
-            url = f"{self._base_url}/v2/payments"
-            async with session.post(url, json=payload, headers=headers) as response:
-                result = await response.json()
-                if response.status != 201 or not result.get("success"):
-                    raise RuntimeError(
-                        f"UrlPay create payment failed: status={response.status}, body={result}"
-                    )
+        http = await self._get_http()
+        url = f"{self._base_url}/v2/payments"
+        async with http.post(
+            url, data=orjson.dumps(payload), headers=self._auth_headers
+        ) as response:
+            result = await response.json(loads=orjson.loads)
+            if response.status != 201 or not result.get("success"):
+                raise RuntimeError(
+                    f"UrlPay create payment failed: status={response.status}, body={result}"
+                )
 
         payment_id = str(result["id"])
         payment_url = result.get("paymentUrl")
@@ -129,9 +164,35 @@ class UrlPay(PaymentGateway):
                 status=TransactionStatus.PENDING,
             )
 
-        logger.info(f"Payment link created for user {data.user_id}: {payment_url}")
+        logger.info("Payment link created for user %s: %s", data.user_id, payment_url)
         return payment_url
 
+    async def _get_http(self) -> aiohttp.ClientSession:
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=32,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=60,
+                ),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self._http
+
+    async def _get_redirect_url(self) -> str:
+        if self._redirect_url is None:
+            async with self._redirect_url_lock:
+                if self._redirect_url is None:
+                    bot_username = (await self.bot.get_me()).username
+                    self._redirect_url = f"https://t.me/{bot_username}"
+        return self._redirect_url
+
+    async def _on_cleanup(self, app: Application) -> None:
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        self._http = None
+
     async def handle_payment_succeeded(self, payment_id: str) -> None:
         await self._on_payment_succeeded(payment_id)
 
@@ -140,112 +201,138 @@ class UrlPay(PaymentGateway):
 
     async def webhook_handler(self, request: Request) -> Response:
         try:
-            payload = await request.json()
-            logger.debug(f"Received UrlPay webhook payload: {payload}")
+            try:
+                payload = orjson.loads(await request.read())
+            except orjson.JSONDecodeError:
+                logger.warning("Received malformed UrlPay webhook payload.")
+                return Response(status=400)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received UrlPay webhook payload: %s", payload)
 
             payment_status_raw = payload.get("payment_status", "")
             payment_status = str(payment_status_raw).lower()
-            if payment_status not in {"success", "cancel"}:
-                logger.warning(f"Unsupported UrlPay status: {payment_status_raw}")
+            if payment_status not in _STATUS_HANDLERS:
+                logger.warning("Unsupported UrlPay status: %s", payment_status_raw)
                 return Response(status=400)
 
-            payment_id = await self._verify_callback(payload, payment_status)
-            if not payment_id:
-                logger.warning("UrlPay webhook verification failed.")
+            payment_id = payload.get("id")
+            payment_uuid = payload.get("uuid")
+            if not payment_id or not payment_uuid:
+                logger.warning("UrlPay webhook payload does not contain id or uuid.")
                 return Response(status=400)
-
-            if payment_status == "success":
-                await self.handle_payment_succeeded(payment_id)
-            else:
-                await self.handle_payment_canceled(payment_id)
-
-            return Response(status=200)
+            if type(payment_id) is not str:
+                payment_id = str(payment_id)
+            if type(payment_uuid) is not str:
+                payment_uuid = str(payment_uuid)
+
+            key = (payment_id, payment_uuid, payment_status)
+            if key in self._processing:
+                # Not acknowledged so UrlPay redelivers it if the in-flight one fails.
+                logger.info("UrlPay webhook for payment %s is already being processed.", payment_id)
+                return Response(status=409)
+
+            self._processing.add(key)
+            try:
+                result = await self._verify_callback(payment_id, payment_uuid, payment_status)
+                if result is _CallbackResult.ALREADY_COMPLETED:
+                    return Response(status=200)
+                if result is _CallbackResult.REJECTED:
+                    logger.warning("UrlPay webhook verification failed.")
+                    return Response(status=400)
+
+                await getattr(self, _STATUS_HANDLERS[payment_status])(payment_id)
+                return Response(status=200)
+            finally:
+                self._processing.discard(key)
 
         except Exception as exception:
-            logger.exception(f"Error processing UrlPay webhook: {exception}")
+            logger.exception("Error processing UrlPay webhook: %s", exception)
             return Response(status=400)
 
     def _generate_signature(self, amount: str) -> str:
-        payload = (
-            f"{self.currency.code.lower()}"
-            f"{amount}"
-            f"{self.config.urlpay.SHOP_ID}"
-            f"{self.config.urlpay.SECRET_KEY}"
-        )
-        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
-
-    async def _verify_callback(self, payload: dict[str, Any], payment_status: str) -> str | None:
-        payment_id_raw = payload.get("id")
-        if payment_id_raw is None:
-            logger.warning("UrlPay callback payload does not contain payment id.")
-            return None
-
-        payment_id = str(payment_id_raw)
-        payment_uuid_raw = payload.get("uuid")
-        payment_uuid = str(payment_uuid_raw) if payment_uuid_raw else None
-        if not payment_uuid:
-            logger.warning(
-                "UrlPay callback payload does not contain uuid for payment %s.",
-                payment_id,
-            )
-            return None
+        signature = self._sig_prefix_hash.copy()
+        signature.update(amount.encode("ascii"))
+        signature.update(self._sig_suffix)
+        return signature.hexdigest()
 
+    async def _verify_callback(
+        self,
+        payment_id: str,
+        payment_uuid: str,
+        payment_status: str,
+    ) -> _CallbackResult:
         async with self.session() as session:
             transaction = await Transaction.get_by_id(session=session, payment_id=payment_id)
+            # End the read transaction so no connection is held during the API call.
+            await session.commit()
 
-        if not transaction:
-            logger.warning(
-                "UrlPay callback received for unknown payment id %s.",
-                payment_id,
-            )
-            return None
-
-        payment = await self._fetch_payment(payment_id)
-        if not payment:
-            return None
-
-        api_uuid = payment.get("uuid")
-        api_uuid_str = str(api_uuid) if api_uuid else None
-        transaction_uuid = (
-            str(transaction.payment_uuid) if transaction.payment_uuid else None
-        )
-
-        if transaction_uuid and api_uuid_str and api_uuid_str != transaction_uuid:
-            logger.warning(
-                "UrlPay callback uuid mismatch between database and API: db=%s, api=%s, payment_id=%s",
-                transaction_uuid,
-                api_uuid_str,
-                payment_id,
-            )
-            return None
-
-        expected_uuid = transaction_uuid
-        updated_uuid: str | None = None
+            if not transaction:
+                logger.warning(
+                    "UrlPay callback received for unknown payment id %s.",
+                    payment_id,
+                )
+                return _CallbackResult.REJECTED
 
-        if not expected_uuid and api_uuid_str:
-            expected_uuid = api_uuid_str
-            updated_uuid = api_uuid_str
-        elif not expected_uuid and payment_uuid:
-            expected_uuid = payment_uuid
-            updated_uuid = payment_uuid
+            if transaction.status == TransactionStatus.COMPLETED:
+                logger.info(
+                    "UrlPay callback received for already completed payment %s.",
+                    payment_id,
+                )
+                return _CallbackResult.ALREADY_COMPLETED
+
+            db_uuid = transaction.payment_uuid
+            transaction_uuid = str(db_uuid) if db_uuid else None
+            # Webhooks are unsigned, so only cancellations may skip the API check.
+            if (
+                not self.config.urlpay.VERIFY_VIA_API
+                and payment_status == "cancel"
+                and transaction_uuid == payment_uuid
+            ):
+                logger.info(
+                    "UrlPay callback verified locally: payment_id=%s, payment_uuid=%s",
+                    payment_id,
+                    payment_uuid,
+                )
+                return _CallbackResult.VERIFIED
+
+            # Only ids already stored in the database reach the authenticated API call.
+            payment = await self._fetch_payment(payment_id)
+            if not payment:
+                return _CallbackResult.REJECTED
+
+            api_uuid = payment.get("uuid")
+            api_uuid_str = str(api_uuid) if api_uuid else None
+
+            if transaction_uuid and api_uuid_str and api_uuid_str != transaction_uuid:
+                logger.warning(
+                    "UrlPay callback uuid mismatch between database and API: db=%s, api=%s, payment_id=%s",
+                    transaction_uuid,
+                    api_uuid_str,
+                    payment_id,
+                )
+                return _CallbackResult.REJECTED
 
-        if updated_uuid:
-            async with self.session() as session:
-                await Transaction.update(
+            expected_uuid = transaction_uuid
+            if not expected_uuid:
+                transaction = await Transaction.get_and_set_uuid_if_missing(
                     session=session,
                     payment_id=payment_id,
-                    payment_uuid=updated_uuid,
+                    payment_uuid=api_uuid_str or payment_uuid,
                 )
-            transaction_uuid = updated_uuid
-
-        if not expected_uuid:
-            logger.warning(
-                "UrlPay callback cannot determine expected uuid for payment %s.",
-                payment_id,
-            )
-            return None
+                if not transaction:
+                    return _CallbackResult.REJECTED
+                # Another callback may have stored a different uuid concurrently.
+                expected_uuid = transaction.payment_uuid
+                if api_uuid_str and expected_uuid != api_uuid_str:
+                    logger.warning(
+                        "UrlPay callback uuid mismatch between database and API: db=%s, api=%s, payment_id=%s",
+                        expected_uuid,
+                        api_uuid_str,
+                        payment_id,
+                    )
+                    return _CallbackResult.REJECTED
 
-        if payment_uuid and expected_uuid and payment_uuid != expected_uuid:
+        if payment_uuid != expected_uuid:
             logger.warning(
                 "UrlPay payload uuid differs from expected: payload=%s, expected=%s, payment_id=%s",
                 payment_uuid,
@@ -253,43 +340,35 @@ class UrlPay(PaymentGateway):
                 payment_id,
             )
 
-        status_map = {
-            "success": {3},
-            "cancel": {4, 5, 6},
-        }
-        expected_status = status_map.get(payment_status)
+        expected_status = _STATUS_MAP.get(payment_status)
         if expected_status and payment.get("status") not in expected_status:
             logger.warning(
                 "UrlPay callback status mismatch: payload=%s, api_status=%s",
                 payment_status,
                 payment.get("status"),
             )
-            return None
+            return _CallbackResult.REJECTED
 
-        return payment_id
+        logger.info(
+            "UrlPay callback verified via API: payment_id=%s, payment_uuid=%s",
+            payment_id,
+            expected_uuid,
+        )
+        return _CallbackResult.VERIFIED
 
     async def _fetch_payment(self, payment_id: Any) -> dict[str, Any] | None:
-        if not self.config.urlpay.API_KEY:
-            logger.error("UrlPay API key is missing.")
-            return None
-
-        headers = {
-            "Authorization": f"Bearer {self.config.urlpay.API_KEY}",
-            "Content-Type": "application/json",
-        }
-
-        async with aiohttp.ClientSession() as session:
-            url = f"{self._base_url}/v2/payments/{payment_id}"
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    logger.warning(
-                        "Failed to fetch UrlPay payment: status=%s, payment_id=%s",
-                        response.status,
-                        payment_id,
-                    )
-                    return None
+        http = await self._get_http()
+        url = f"{self._base_url}/v2/payments/{payment_id}"
+        async with http.get(url, headers=self._auth_headers) as response:
+            if response.status != 200:
+                logger.warning(
+                    "Failed to fetch UrlPay payment: status=%s, payment_id=%s",
+                    response.status,
+                    payment_id,
+                )
+                return None
 
-                result = await response.json()
+            result = await response.json(loads=orjson.loads)
 
         if not result.get("success"):
             logger.warning("UrlPay payment fetch returned unsuccessful response: %s", result)
@@ -41,6 +41,7 @@ DEFAULT_SHOP_PAYMENT_HELEKET_ENABLED = False
 DEFAULT_SHOP_PAYMENT_YOOKASSA_ENABLED = False
 DEFAULT_SHOP_PAYMENT_YOOMONEY_ENABLED = False
 DEFAULT_SHOP_PAYMENT_URLPAY_ENABLED = False
+DEFAULT_URLPAY_VERIFY_VIA_API = True
 DEFAULT_DB_NAME = "bot_database"
 
 DEFAULT_REDIS_DB_NAME = "0"
@@ -119,6 +120,7 @@ class UrlPayConfig:
     API_KEY: str | None
     SHOP_ID: int | None
     SECRET_KEY: str | None
+    VERIFY_VIA_API: bool
 
 
 @dataclass
@@ -389,6 +391,10 @@ def load_config() -> Config:
             API_KEY=urlpay_api_key,
             SHOP_ID=urlpay_shop_id,
             SECRET_KEY=urlpay_secret_key,
+            VERIFY_VIA_API=env.bool(
+                "URLPAY_VERIFY_VIA_API",
+                default=DEFAULT_URLPAY_VERIFY_VIA_API,
+            ),
         ),
         yookassa=YooKassaConfig(
             TOKEN=env.str("YOOKASSA_TOKEN", default=None),
@@ -110,3 +110,33 @@ class Transaction(Base):
 
         logger.warning(f"Transaction {payment_id} not found for update.")
         return None
+
+    @classmethod
+    async def get_and_set_uuid_if_missing(
+        cls,
+        session: AsyncSession,
+        payment_id: str,
+        payment_uuid: str,
+    ) -> Self | None:
+        filter = [Transaction.payment_id == payment_id, Transaction.payment_uuid.is_(None)]
+        statement = update(Transaction).where(*filter).values(payment_uuid=payment_uuid)
+
+        # SQLite < 3.35 has no RETURNING; fall back to a follow-up select there.
+        returning = session.get_bind().dialect.update_returning
+        if returning:
+            statement = statement.returning(Transaction)
+
+        query = await session.execute(statement)
+        transaction = query.scalar_one_or_none() if returning else None
+        await session.commit()
+
+        if transaction:
+            logger.info(f"Transaction {payment_id} uuid set.")
+            return transaction
+
+        query = await session.execute(
+            select(Transaction)
+            .where(Transaction.payment_id == payment_id)
+            .execution_options(populate_existing=True)
+        )
+        return query.scalar_one_or_none()